@@ -1,71 +1,304 @@
 import re
+import codecs
 import csv
+import gzip
 import io
-from flask import Flask, request, jsonify, render_template_string
-from presidio_analyzer import AnalyzerEngine
-from presidio_anonymizer import AnonymizerEngine
-from presidio_anonymizer.entities import OperatorConfig
+import logging
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from itertools import chain, islice, zip_longest
+import orjson
+from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+from presidio_analyzer import AnalyzerEngine, BatchAnalyzerEngine, RecognizerRegistry
+from presidio_analyzer.nlp_engine import NlpEngineProvider
+
+# PII entity types detected by the tool. Only the recognizers for these types
+# are loaded, so every analyzer call runs as few recognizers as possible.
+SUPPORTED_ENTITIES = ["CREDIT_CARD", "EMAIL_ADDRESS", "IN_AADHAAR", "PERSON", "PHONE_NUMBER"]
+
+# Card and Aadhaar numbers have at least 12 digits, so values shorter than
+# that are only checked for the remaining entity types.
+MIN_ID_NUMBER_LENGTH = 12
+SHORT_VALUE_ENTITIES = ["EMAIL_ADDRESS", "PERSON", "PHONE_NUMBER"]
 
 # Create Presidio instances
-analyzer = AnalyzerEngine()
-anonymizer = AnonymizerEngine()
+nlp_engine = NlpEngineProvider(nlp_configuration={
+    "nlp_engine_name": "spacy",
+    "models": [{"lang_code": "en", "model_name": "en_core_web_sm"}],
+}).create_engine()
+registry = RecognizerRegistry()
+registry.load_predefined_recognizers(languages=["en"], nlp_engine=nlp_engine)
+registry.recognizers = [
+    recognizer for recognizer in registry.recognizers
+    if set(recognizer.supported_entities) & set(SUPPORTED_ENTITIES)
+]
+analyzer = AnalyzerEngine(registry=registry, nlp_engine=nlp_engine, supported_languages=["en"])
+batch_analyzer = BatchAnalyzerEngine(analyzer_engine=analyzer)
+
+logger = logging.getLogger(__name__)
+
+# Uploads are read, de-identified and written out this many rows at a time,
+# so only a few batches of rows are held in memory at once.
+ROWS_PER_BATCH = 10_000
+
+# Number of values spaCy processes per nlp.pipe batch. Presidio defaults to 1,
+# which would analyze the values one at a time. Passing batch_size through
+# analyze_dict needs presidio-analyzer 2.2.354 or later.
+ANALYZER_BATCH_SIZE = 256
+
+# Cheap pre-filter for cells that could contain PII. Cells that match none of
+# these (short numbers, lowercase words, flags) are never sent to Presidio.
+# Kept deliberately loose to avoid missing PII:
+#   @                  email addresses
+#   \d{3,}             card and Aadhaar numbers
+#   (?:\d\D{0,3}){7}   phone numbers, counted by digits rather than by digit
+#                      runs so that numbers written in short groups such as
+#                      "+33 1 23 45 67 89", "06 12 34 56 78",
+#                      "+91 98 76 54 32 10" and "01.23.45.67.89" still pass
+#   [A-Z][A-Za-z]      person names
+_PII_GATE = re.compile(r"@|\d{3,}|(?:\d\D{0,3}){7}|[A-Z][A-Za-z]")
+
+# Text that replaces each detected PII entity
+REDACTED = "XXXXXX"
+
+def _redact(text, results):
+    """
+    Replaces every detected PII span in the text with REDACTED.
+    Overlapping spans are merged and replaced once.
+    """
+    spans = []
+    for result in sorted(results, key=lambda result: result.start):
+        if spans and result.start < spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], result.end)
+        else:
+            spans.append([result.start, result.end])
+
+    for start, end in reversed(spans):
+        text = text[:start] + REDACTED + text[end:]
+    return text
+
+def _deidentify_rows(rows):
+    """
+    De-identifies a list of CSV rows.
+    Returns the de-identified rows and the count of each PII entity type found.
+    """
+    pii_found = Counter()
+
+    # Transpose the rows into columns so each column is analyzed in batches
+    # (spaCy pipe passes) instead of one analyzer call per cell. Repeated
+    # values are analyzed once per column and their result is reused for
+    # every cell holding the same value; values that fail the PII gate are
+    # left as they are. Values shorter than MIN_ID_NUMBER_LENGTH go through a
+    # second analyze_dict pass restricted to SHORT_VALUE_ENTITIES, because the
+    # entities to look for are set per call, not per value.
+    transposed = list(zip_longest(*rows, fillvalue=""))
+    long_columns = {}
+    short_columns = {}
+    occurrences = {}
+    for i, column in enumerate(transposed):
+        value_counts = Counter(column)
+        occurrences[str(i)] = value_counts
+        # filter() calls the compiled pattern directly, with no Python-level
+        # code per value. Blank values never match the gate.
+        candidates = list(filter(_PII_GATE.search, value_counts))
+        long_columns[str(i)] = [value for value in candidates if len(value) >= MIN_ID_NUMBER_LENGTH]
+        short_columns[str(i)] = [value for value in candidates if len(value) < MIN_ID_NUMBER_LENGTH]
+    analyzer_results = list(chain(
+        batch_analyzer.analyze_dict(
+            long_columns, language='en', entities=SUPPORTED_ENTITIES,
+            batch_size=ANALYZER_BATCH_SIZE,
+        ),
+        batch_analyzer.analyze_dict(
+            short_columns, language='en', entities=SHORT_VALUE_ENTITIES,
+            batch_size=ANALYZER_BATCH_SIZE,
+        ),
+    ))
+    # The arguments loop over every row, so only compute them when logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Analyzed %d distinct candidate values for %d cells",
+            sum(len(values) for values in chain(long_columns.values(), short_columns.values())),
+            sum(len(row) for row in rows),
+        )
+
+    # Anonymize the detected PII and update the summary report counts
+    replacements = {}
+    for column_result in analyzer_results:
+        value_counts = occurrences[column_result.key]
+        column_replacements = replacements.setdefault(int(column_result.key), {})
+        for value, results in zip(column_result.value, column_result.recognizer_results):
+            if not results:
+                continue
+            column_replacements[value] = _redact(value, results)
+            occurrences_of_value = value_counts[value]
+            for entity in results:
+                pii_found[entity.entity_type] += occurrences_of_value
+
+    # Apply the replacements a column at a time with map() and transpose back
+    # with zip(), so no Python-level code runs per cell. Slicing trims the
+    # padding zip_longest added to rows shorter than the widest one.
+    if not any(replacements.values()):
+        return rows, pii_found
+    deidentified_columns = [
+        map(replacements[i].get, column, column) if replacements.get(i) else column
+        for i, column in enumerate(transposed)
+    ]
+    deidentified_rows = [
+        values[:len(row)] for row, values in zip(rows, zip(*deidentified_columns))
+    ]
+
+    return deidentified_rows, pii_found
+
+_pool = None
+_pool_processes = 0
+
+def start_pool(processes):
+    """
+    Starts the worker process pool that de-identifies batches of rows.
+    Must be called before the process handles any request: the workers are
+    forked, so they share the loaded analyzer instead of reloading the spaCy
+    model, but they would also keep a copy of any request data held at the
+    time. Without a pool, batches are de-identified in the calling process.
+    """
+    global _pool, _pool_processes
+    if _pool is not None or processes < 2:
+        return
+    _pool = ProcessPoolExecutor(max_workers=processes, mp_context=get_context("fork"))
+    _pool_processes = processes
+    # The executor forks its workers when tasks are submitted, so keep every
+    # worker busy once now to make sure they all exist before any request.
+    for future in [_pool.submit(time.sleep, 0.1) for _ in range(processes)]:
+        future.result()
+
+def _stop_pool(pool):
+    """
+    Shuts down a broken worker pool so later uploads are processed serially.
+    Restarting it here would fork workers that inherit the current upload.
+    """
+    global _pool
+    if _pool is pool:
+        _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
 
-def deidentify_data(input_csv_content):
+def _deidentify_batches(reader):
     """
-    Processes CSV content to detect and de-identify PII using Presidio.
+    Reads rows from the CSV reader in batches of ROWS_PER_BATCH and
+    de-identifies them, in the worker pool if one was started.
+    Yields the de-identified rows and PII counts of each batch, in order.
+    """
+    batches = iter(lambda: list(islice(reader, ROWS_PER_BATCH)), [])
+    pool = _pool
+    if pool is None:
+        for batch in batches:
+            yield _deidentify_rows(batch)
+        return
+
+    # Batches are independent, so they are de-identified in parallel. Reading
+    # stops once every worker has a batch and one more is queued, and resumes
+    # as the oldest batch is written out.
+    pending = deque()
+    futures = deque()
+    try:
+        for batch in batches:
+            pending.append(batch)
+            futures.append(pool.submit(_deidentify_rows, batch))
+            if len(futures) > _pool_processes:
+                yield futures[0].result()
+                futures.popleft()
+                pending.popleft()
+        while futures:
+            yield futures[0].result()
+            futures.popleft()
+            pending.popleft()
+    except BrokenProcessPool:
+        # A worker died, e.g. killed for running out of memory. Finish this
+        # upload, and handle later ones, in this process instead of failing.
+        logger.warning("De-identification worker pool broke, continuing serially")
+        _stop_pool(pool)
+        for batch in chain(pending, batches):
+            yield _deidentify_rows(batch)
+
+def deidentify_data(input_csv_stream):
+    """
+    Processes a binary stream of UTF-8 CSV content to detect and de-identify
+    PII using Presidio.
     Returns the de-identified data and a summary report.
     """
-    deidentified_lines = []
-    total_pii_found = {}
+    total_pii_found = Counter()
+    output_buffer = io.StringIO()
+    writer = csv.writer(output_buffer)
     
-    csv_file = io.StringIO(input_csv_content)
-    reader = csv.reader(csv_file)
+    # Decode the upload line by line as it is parsed instead of reading and
+    # decoding the whole file into a string first. codecs.iterdecode only
+    # needs the stream to be iterable, unlike io.TextIOWrapper, which fails on
+    # the SpooledTemporaryFile Werkzeug uses for large uploads before
+    # Python 3.11.
+    reader = csv.reader(codecs.iterdecode(input_csv_stream, 'utf-8'))
     header = next(reader)
-    deidentified_lines.append(header)
-    
-    for row in reader:
-        deidentified_row = list(row)
-        for i, cell in enumerate(row):
-            if cell.strip() == "":
-                continue
+    writer.writerow(header)
 
-            # Analyze the text for PII entities
-            results = analyzer.analyze(text=cell, language='en')
-            
-            if results:
-                # Anonymize the detected PII
-                anonymized_result = anonymizer.anonymize(
-                    text=cell,
-                    analyzer_results=results,
-                    operators={"DEFAULT": OperatorConfig("replace", {"new_value": "XXXXXX"})},
-                )
-                deidentified_row[i] = anonymized_result.text
-
-                # Update the summary report counts
-                for entity in results:
-                    entity_type = entity.entity_type
-                    total_pii_found[entity_type] = total_pii_found.get(entity_type, 0) + 1
-        
-        deidentified_lines.append(deidentified_row)
+    # Each batch is written out before more rows are read
+    for deidentified_rows, pii_found in _deidentify_batches(reader):
+        writer.writerows(deidentified_rows)
+        total_pii_found.update(pii_found)
 
     report_content = "Summary Report\n"
     report_content += "--------------\n"
     if total_pii_found:
-        for key, count in total_pii_found.items():
+        for key, count in total_pii_found.most_common():
             report_content += f"Total {key.replace('_', ' ').title()} found: {count}\n"
     else:
         report_content += "No PII found in the provided data.\n"
-    
-    output_buffer = io.StringIO()
-    writer = csv.writer(output_buffer)
-    writer.writerows(deidentified_lines)
+
     deidentified_csv = output_buffer.getvalue()
 
     return deidentified_csv, report_content
 
 # --- Flask Web Application ---
 
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, which escapes the large de-identified CSV
+    strings much faster than the standard library json module. Types orjson
+    does not handle natively, and dates, fall back to Flask's default
+    conversion so responses match DefaultJSONProvider.
+    """
+
+    default = staticmethod(DefaultJSONProvider.default)
+
+    def _dumps_bytes(self, obj, sort_keys=False, indent=None):
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def dumps(self, obj, **kwargs):
+        # Only the json.dumps arguments orjson has an equivalent for are
+        # honoured. orjson always writes compact UTF-8, so separators and
+        # ensure_ascii (as passed by Flask's session serializer) are ignored.
+        return self._dumps_bytes(
+            obj, sort_keys=kwargs.get("sort_keys", False), indent=kwargs.get("indent")
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Build the body from orjson's bytes directly, rather than decoding
+        # the large CSV payload to a str only for Werkzeug to encode it again.
+        if len(args) != 1 or kwargs:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(self._dumps_bytes(args[0]), mimetype="application/json")
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # This is the HTML template for the web application
 HTML_TEMPLATE = """
@@ -243,9 +476,25 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# The template has no variables, so it is compiled and rendered once at import
+INDEX_HTML = app.jinja_env.from_string(HTML_TEMPLATE).render()
+
 @app.route("/")
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return INDEX_HTML
+
+def gzip_response(response):
+    """
+    Gzip-compresses the response body if the client accepts it.
+    Level 1 is the fastest and still shrinks CSV text several times over.
+    """
+    response.vary.add("Accept-Encoding")
+    if not request.accept_encodings["gzip"]:
+        return response
+
+    response.set_data(gzip.compress(response.get_data(), compresslevel=1))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
 
 @app.route("/process", methods=["POST"])
 def process_file():
@@ -258,15 +507,15 @@ def process_file():
     
     if file:
         try:
-            csv_content = file.read().decode('utf-8')
-            deidentified_csv, report_content = deidentify_data(csv_content)
+            deidentified_csv, report_content = deidentify_data(file.stream)
             
-            return jsonify({
+            return gzip_response(jsonify({
                 "deidentified_csv": deidentified_csv,
                 "report": report_content
-            })
+            }))
         except Exception as e:
             return jsonify({"error": f"An error occurred during processing: {e}"}), 500
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    start_pool(os.cpu_count() or 1)
+    app.run()
@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+
+# Import app.py, and load its Presidio analyzer and spaCy model, once in the
+# master process so the workers share it copy-on-write.
+preload_app = True
+
+# Each web worker de-identifies large uploads with its own pool of processes,
+# and the CPUs are split between those pools (see post_fork). More web workers
+# serve more uploads at once, but each upload then gets fewer processes. The
+# default of 2 keeps most CPUs available to every pool; on a machine with
+# many cores, or for many concurrent small uploads, raise it with -w or
+# WEB_CONCURRENCY.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+# A file of a few hundred thousand rows can take minutes to run through
+# spaCy, and the whole file is processed within the request, so the timeout
+# has to cover the largest upload expected rather than typical requests.
+timeout = 600
+
+def post_fork(server, worker):
+    # Start each web worker's de-identification pool before it serves any
+    # request, so the pool's processes never inherit upload data.
+    from app import start_pool
+    processes = int(os.environ.get(
+        "DEIDENTIFY_PROCESSES",
+        max(1, multiprocessing.cpu_count() // server.cfg.workers),
+    ))
+    start_pool(processes)